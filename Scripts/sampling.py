@@ -0,0 +1,320 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Eva Bühlmann, BA
+#
+# GOAL:
+# - Sample ads from XML files (shared by extract_sample-0.py and extract_topic-based-samples.py)
+# - Extract relevant text zones from sampled ads.
+#
+# Which ads are selected is defined by the scripts with two functions:
+# - matcher(ad_id, text): runs in the worker processes, returns match (e.g. found terms) or None
+# - selector(match): runs in the main process, returns label for id-file (e.g. topic) or None. Updates selection state.
+
+import os
+from lxml import etree
+import bz2
+import json
+import re
+import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+try:
+    import indexed_bzip2  # parallel bz2-decompression (optional)
+except ImportError:
+    indexed_bzip2 = None
+
+
+class ZoneGroups(dict):
+    """Cache: zone attribute of token/space (string) -> zone rounded to tens (integer)"""
+
+    def __missing__(self, zone):
+        zone_group = self[zone] = int(zone) // 10 * 10
+        return zone_group
+
+
+# zones of all parsed ads (only a few different values -> int() is computed once per value)
+ZONE_GROUPS = ZoneGroups()
+
+
+class TokenTexts(dict):
+    """Cache: text of token/space -> one shared string per distinct text (no text -> empty string)"""
+
+    def __missing__(self, text):
+        token_text = self[text] = text or ''
+        return token_text
+
+
+# year in file names of x28 and adecco files
+YEAR_X28 = re.compile(r'ads_zoned_(\d{4})')
+YEAR_ADECCO = re.compile(r'ads_annotated_ji_instexte_(\d{4})')
+
+
+def sample_files(files, outfile, sample_name, source, samplingdict, matcher, selector, existing_ids, idfile,
+                 multi_year_files=(), max_ads_per_file=None, id_filter=None, zones=(60, 70), threshold=10,
+                 oversample=100, initializer=None, initargs=()):
+    """Sample ads from several XML files (bz2-compressed). Candidates are extracted from the files in parallel
+    (one process per file), ads are sampled from the candidates of a file as soon as the file is processed.
+
+    :param files: list with paths to XML files
+    :param multi_year_files: paths of files which contain ads from several years. Default: none
+    :param oversample: Number of ads read from file per missing ad (remaining quota * oversample). Default: 100.
+    :param initializer: function to initialize worker processes, called with initargs. Default: None
+    Other parameters: see sample_ads and extract_candidates
+    """
+
+    if samplingdict['total'] == 0:  # enough ads sampled for this source
+        return
+
+    # years with missing ads (quotas only decrease -> ads from other years are never needed)
+    years = frozenset(year for year, number in samplingdict.items() if year != 'total' and number > 0)
+
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=initializer, initargs=initargs) as executor:
+        futures = {}
+        for infile in files:
+            quota = remaining_quota(infile, source, samplingdict)
+            if quota > 0:
+                future = executor.submit(extract_candidates, infile, source, years, existing_ids, matcher,
+                                         quota * oversample, id_filter, zones, threshold)
+                futures[future] = infile
+
+        # merge candidates in order of completion, quotas are only updated here
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            infile = futures[future]
+            sample_ads(future.result(), infile, outfile, sample_name, source, samplingdict, selector, existing_ids,
+                       idfile, multi_year_file=infile in multi_year_files, max_ads_per_file=max_ads_per_file)
+
+            # files which are not needed anymore (quota for year/total reached) are not opened, if not started yet
+            for pending, pending_file in futures.items():
+                if not pending.done() and remaining_quota(pending_file, source, samplingdict) == 0:
+                    pending.cancel()
+
+
+def remaining_quota(infile, source, samplingdict):
+    """Return number of ads still needed from file. Year is only known from file name for x28 and adecco files
+    (sjmm-files: max. 1 file per year -> total is used)"""
+
+    if source == 'sjmm':
+        return samplingdict['total']
+    if source == 'x28':
+        year = int(YEAR_X28.search(infile).group(1))
+    else:
+        year = int(YEAR_ADECCO.search(infile).group(1))
+    return min(samplingdict[year], samplingdict['total'])
+
+
+def extract_candidates(infile, source, years, existing_ids, matcher, sample_size, id_filter=None, zones=(60, 70),
+                       threshold=10):
+    """Extract candidate ads from XML file (bz2-compressed): German ads (2001 or later, not extracted before) with
+    text from selected zones, which are matched by matcher. Does not change any state, runs in a worker process.
+    Ads are filtered with cheap checks on attributes while parsing, before they enter the random sample.
+
+    :param infile: path to XML file
+    :param source: x28, adecco or sjmm
+    :param years: set with years for which ads are needed
+    :param existing_ids: set with ids of already extracted ads
+    :param matcher: function (ad_id, text) -> match or None, only matched ads are candidates
+    :param sample_size: number of ads read from file (random sample)
+    :param id_filter: function ad_id -> bool, checked before the ad is read. Default: None (all ads)
+
+    :param zones: Set with integers which define text zones to consider. Default: zones 60 & 70.
+    :param threshold: Integer, defines how many tokens/spaces around selected zones are considered. Default: 10.
+
+    :return: list with candidates in random order, tuples (ad_id, year, lang, text, match)
+    """
+
+    candidates = []
+    seen_in_file = set()  # ids of ads considered in this file
+
+    def keep(ad):
+        # cheap checks on attributes of ad element first, language (content element) last
+        ad_id = source + '-' + ad.get('id')
+        if ad_id in existing_ids or (id_filter is not None and not id_filter(ad_id)):
+            return False
+        year = int(ad.get('year'))
+        if year < 2001 or year not in years:
+            return False
+        return ad[0].get('language') == 'de'  # only german ads are considered
+
+    # one decompression thread per file: files are already processed in parallel (one worker process per core)
+    for ad_id, year, lang, tokens in read_random_ads(infile, sample_size, keep, parallelization=1):
+        ad_id = source + '-' + ad_id
+
+        # exclude duplicates WITHIN Files
+        if ad_id in seen_in_file:
+            continue
+        seen_in_file.add(ad_id)
+
+        # Extract text from ad, only keep it, if it is matched
+        extracted_text = extract_text(tokens, zones, threshold)
+        if extracted_text and 200 <= len(extracted_text) <= 2500:  # exclude very short and long ads
+            match = matcher(ad_id, extracted_text)
+            if match is not None:
+                candidates.append((ad_id, year, lang, extracted_text, match))
+
+    return candidates
+
+
+def sample_ads(candidates, infile, outfile, sample_name, source, samplingdict, selector, existing_ids, idfile,
+               multi_year_file=False, max_ads_per_file=None):
+    """Sample ads from candidates of an XML file.
+
+    Extracted text is stored in a jsonl-File with "id", "text" and "meta". Example:
+    {"id": "sjmm-12001121020008", "text": "\nCoop\nVerkäufer/in\n(2 Jahre)\... und umfassende Ausbildung.",
+    "meta": {"year": 2001, "source": "sjmm", "lang": "de"}}
+
+    :param candidates: candidate ads from extract_candidates
+    :param infile: path to XML file
+    :param outfile: opened jsonl-file, extracted ads are appended
+    :param sample_name: name of sample
+    :param source: x28, adecco or sjmm
+
+    :param samplingdict: dictionary with desired nr of ads per year (key: year, value: number)
+    :param selector: function match -> label for id-file (topic column) or None, if ad is not selected.
+    Called only if the ad is sampled otherwise, so it can update its selection state.
+
+    :param existing_ids: set with ids of already extracted ads, which are excluded. New ids are added.
+    :param idfile: opened id-file, ids of extracted ads are appended
+    Format: tab separated txt-file (sample_name\tad_id\tsource\tyear\ttopic\tinfile')
+
+    :param multi_year_file: File contains ads from several years. Default: False
+    :param max_ads_per_file: Max number of ads from this file, in order to have ads from multiple files.
+    Default: None (no limit)
+    """
+
+    number_of_ads_extracted = 0
+
+    for ad_id, year, lang, extracted_text, match in candidates:
+        # stop sampling when enough ads per year/source sampled
+        if samplingdict['total'] == 0:
+            break
+
+        if samplingdict[year] == 0:
+            if multi_year_file:
+                continue  # Look for other years in file (only for files with multiple years)
+            else:
+                break  # No need to iterate over whole file
+
+        if max_ads_per_file is not None and number_of_ads_extracted >= max_ads_per_file:
+            break
+
+        # if ad has been extracted before ->ignore it
+        if ad_id in existing_ids:
+            continue
+
+        label = selector(match)
+        if label is None:
+            continue
+
+        zone_json = {'id': ad_id, 'text': extracted_text}
+        zone_json['meta'] = {'year': year, 'source': source, 'lang': lang}
+        print(json.dumps(zone_json, ensure_ascii=False), file=outfile)
+
+        # Update sampling-dict
+        samplingdict[year] -= 1
+        samplingdict['total'] -= 1
+        number_of_ads_extracted += 1
+
+        # Write id of extracted ad in separate file
+        existing_ids.add(ad_id)
+        idfile.write(f'{sample_name}\t{ad_id}\t{source}\t{year}\t{label}\t{infile}\n')
+
+
+def read_existing_ids(id_path):
+    """Return set with ids of already extracted ads (second column of tab separated id-file)
+    :param: id_path: path to id-file"""
+
+    try:
+        with open(id_path, encoding='utf-8') as idfile:
+            return {line.split()[1].rstrip() for line in idfile}
+    except FileNotFoundError:
+        print(f'No existing id-file! New id-file created ({id_path}) ')
+        return set()
+
+
+def open_bz2(infile, parallelization=None):
+    """Open bz2-compressed file in binary mode. Blocks are decompressed in parallel if indexed_bzip2 is installed,
+    otherwise the (single-threaded) bz2 module is used.
+    :param: infile: path to bz2-compressed file
+    :param: parallelization: number of decompression threads (indexed_bzip2 only). Use 1 in worker processes, which
+    already run in parallel. Default: None (all cores, for files read by the main process only)"""
+
+    if indexed_bzip2 is not None:
+        return indexed_bzip2.open(infile, parallelization=parallelization or os.cpu_count())
+    return bz2.open(infile, 'rb')
+
+
+def read_ad(ad, token_texts):
+    """Convert ad element into tuple (id, year, language, tokens), tokens: list with (position, zone rounded to tens,
+    text) of all tokens/spaces. The tuple is still available after the element has been cleared while parsing.
+    :param: ad: lxml.etree._Element of ad
+    :param: token_texts: TokenTexts, texts of tokens/spaces are replaced by the cached string"""
+
+    ad_content = ad[0]
+    # single pass over tokens/spaces, attributes are converted here (elements without text -> empty string)
+    tokens = [(int(el.get('position')), ZONE_GROUPS[el.get('zone')], token_texts[el.text])
+              for el in ad_content.iter("token", "space")]
+    return ad.get('id'), int(ad.get('year')), ad_content.get('language'), tokens
+
+
+def read_random_ads(infile, sample_size, keep=None, parallelization=None):
+    """Stream ads from XML file (bz2-compressed), return random sample of ads (see read_ad) in random order.
+    Reservoir sampling: only sample_size ads are kept in memory, processed ads are freed while parsing.
+    :param: infile: path to XML file
+    :param: sample_size: max. number of ads to return
+    :param: keep: function ad element -> bool, only ads for which it returns True are sampled. Default: all ads
+    :param: parallelization: number of decompression threads, see open_bz2. Default: None (all cores)"""
+
+    reservoir = []
+    n_seen = 0
+    # ads in reservoir share strings of repeated texts (spaces, common words) instead of holding one copy per token
+    token_texts = TokenTexts()
+    with open_bz2(infile, parallelization) as xml_file:
+        context = etree.iterparse(xml_file, events=('end',), tag='ad', huge_tree=True)
+        for _, ad in context:
+            if keep is None or keep(ad):
+                if n_seen < sample_size:
+                    reservoir.append(read_ad(ad, token_texts))
+                else:
+                    j = random.randint(0, n_seen)
+                    if j < sample_size:
+                        reservoir[j] = read_ad(ad, token_texts)
+                n_seen += 1
+
+            # free memory of processed ads
+            ad.clear()
+            while ad.getprevious() is not None:
+                del ad.getparent()[0]
+
+    random.shuffle(reservoir)  # list with ads in random order
+    return reservoir
+
+
+def extract_text(tokens, zones, threshold):
+    """Return text of tokens/spaces belonging to selected zones +/- threshold
+    :param: tokens: list with (position, zone rounded to tens, text) of all tokens/spaces of ad (see read_ad)
+    :param: zones: text zones
+    :param: threshold: threshold of token/spaces around zones"""
+
+    zones_set = frozenset(zones)
+
+    # get positions of all tokens in selected zones:
+    pos_selected_zones = {position for position, zone, _ in tokens if zone in zones_set}
+
+    if len(pos_selected_zones) <= 1:  # If ad doesn't contain any text from selected zones ->ignore it
+        return None
+
+    # mark positions of all tokens in defined threshold around zones (contiguous mask, one slice per zone position)
+    # mask covers all positions, but tokens after zones are only considered up to the position of the last token
+    last_position = tokens[-1][0]
+    pos_selected_all = bytearray(max(position for position, _, _ in tokens) + 1)
+    for position in pos_selected_zones:
+        # tokens before a zone token: only positions > 0 (a zone token at position 0 is kept itself)
+        start = min(position, max(1, position - threshold))
+        end = max(position, min(last_position, position + threshold)) + 1
+        pos_selected_all[start:end] = b'\x01' * (end - start)
+
+    # Extract text from specified zones
+    return ''.join([text for position, _, text in tokens if pos_selected_all[position]])